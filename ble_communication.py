@@ -1,10 +1,24 @@
 # Handles BLE communication with the COAPT EMGC Eval Kit
 
 import os
+import io
+import math
 import asyncio
 import time
+import queue
+import struct
+import threading
 import bleak
-import csv
+
+try:
+    import numpy as np # Binary copy of the recording; CSV is still written without it
+except ImportError:
+    np = None
+
+try:
+    import uvloop # Faster event loop (0.18+ for uvloop.run); not available on Windows
+except ImportError:
+    uvloop = None
 
 
 # TO IMPLEMENT AND DEBUG:
@@ -18,17 +32,39 @@ DEVICE_NAME = 'CC0479' # Hard-coded for now; replace with input
 CUSTOM_SERVICE_UUID = 'bd505a55-c892-4a2d-9fd0-4ed48997e555'
 TX_CHARACTERISTIC_UUID = '799846a2-44c5-44ca-b620-41a48ac4459c'
 RX_CHARACTERISTIC_UUID = 'd6b87f3a-2905-463f-8e5a-40d3dce8c186'
+SCAN_TIMEOUT = 3.0 # Seconds to scan for DEVICE_NAME before giving up
+RX_WRITE_RESPONSE = True # False once RX is known to support write-without-response
 
 STOP_EVENT = asyncio.Event() # To force a hard stop to the program and disconnect
-RECORDING_EVENT = asyncio.Event() # Signals when data should be recorded
 EMG_DATA_FILE = 'emg_data.csv'
 EMG_RECORDING_INTERVAL = 10
-RECORDING_START = None # Changes once recording begins
-PRINT_FLAG = True
+RECORDING_START = None # Set when recording begins (time.monotonic_ns())
+EMG_BUF = None # Kept open for the whole recording
+EMG_FILE_BUFFER_SIZE = 64 * 1024 # Rows are coalesced into writes of this size
+EMG_UNPACK = struct.Struct('>8H').unpack_from # 8 big-endian MRV values after the type byte
+EMG_PACKET_SIZE = 17 # Type byte + 8 two-byte MRV values
+EMG_HEADER = b"Timestamp (ns)," + b",".join(b"Channel %d" % (i+1) for i in range(8)) + b"\n"
+EMG_ROW_FORMAT = b"%d,%d,%d,%d,%d,%d,%d,%d,%d\n" # Timestamp (ns) followed by the 8 channels
+EMG_QUEUE = queue.SimpleQueue() # Rows waiting for the writer thread; None stops it
+EMG_WRITE_BATCH = 32 # Rows collected before each write to EMG_BUF
+EMG_FLUSH_INTERVAL = 1 # Seconds between flushes; bounds data lost on a crash
+EMG_ARRAY = None # Timestamp + 8 channels per row, column-major; owned by the writer thread
+EMG_INDEX = 0 # Number of rows stored in EMG_ARRAY
+EMG_SAMPLE_RATE = 25 # Approximate EMG packets per second, used to size EMG_ARRAY
+
+def noop(*args):
+    return None
+
+def print_message(message, *args):
+    """Prints a %-style message; formatting is skipped entirely when printing is off."""
+    print(message % args)
+    return None
+
+log = print_message # Rebound to noop by set_print_flag(False)
 
 def set_print_flag(flag):
-    global PRINT_FLAG
-    PRINT_FLAG = flag
+    global log
+    log = print_message if flag else noop
 
 def set_record_to_file(file_dir, interval):
     global EMG_DATA_FILE
@@ -38,15 +74,8 @@ def set_record_to_file(file_dir, interval):
 
 async def connect_to_device():
     """Scans for and connects to COAPT EMGC."""
-    # Initialize selected device
-    device = None 
-    
-    # Look for available devices
-    found_devices = await bleak.BleakScanner.discover()
-    for d in found_devices:
-        if d.name == DEVICE_NAME:
-            device = d
-            break
+    # Look for the device; returns as soon as it advertises
+    device = await bleak.BleakScanner.find_device_by_name(DEVICE_NAME, timeout=SCAN_TIMEOUT)
     if device == None:
         print("No devices found.")
         return None
@@ -56,13 +85,27 @@ async def connect_to_device():
         client = bleak.BleakClient(device.address)
         await client.connect()
         print(f"Connected to {device.name}.")
+        await negotiate_mtu(client)
         return client
     except bleak.exc.BleakError as e:
         print(f"Connection failed: {e}.")
         return None
 
+async def negotiate_mtu(client):
+    """Requests a larger ATT MTU where the backend needs it and logs the result."""
+    # WinRT/CoreBluetooth negotiate automatically; BlueZ reports 23 until the MTU is acquired
+    acquire_mtu = getattr(client._backend, '_acquire_mtu', None)
+    if acquire_mtu is not None:
+        try:
+            await acquire_mtu()
+        except bleak.exc.BleakError as e:
+            print(f"MTU negotiation failed: {e}.")
+    print(f"ATT MTU: {client.mtu_size}.")
+    return None
+
 async def get_characteristics(client):
     """Gets TX/RX characteristics."""
+    global RX_WRITE_RESPONSE
     # Get services
     services = await client.get_services()
     custom_service = services.get_service(CUSTOM_SERVICE_UUID)
@@ -73,6 +116,9 @@ async def get_characteristics(client):
     if tx_characteristic == None or rx_characteristic == None:
         print("TX or RX characteristic not found.")
         return None, None
+
+    # Skip the ATT write response when the server allows it
+    RX_WRITE_RESPONSE = "write-without-response" not in rx_characteristic.properties
     return tx_characteristic, rx_characteristic
 
 def handle_tx_data(sender, data):
@@ -81,33 +127,101 @@ def handle_tx_data(sender, data):
 
 def parse_received_data(data):
     """Parses received data. Only retrieves 0x01 and 0x04."""
-    global RECORDING_START
-    message_type = data[0]
-    if message_type == 0x01:
-        # Heartbeat response
-        process_heartbeat_packet(data)
-        if PRINT_FLAG:
-            print("Received heartbeat packet.")
-    elif message_type == 0x04:
-        # EMG signal processing
-        signal_features = process_emg_signal(data)
-        if RECORDING_EVENT.is_set():
-            with open(EMG_DATA_FILE, 'a', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                if RECORDING_START == None:
-                    RECORDING_START = time.time()
-                writer.writerow([time.time()-RECORDING_START] + signal_features) # Adds a timestamp
-                csvfile.close()
-        if PRINT_FLAG:
-            print("Received EMG signal features.")
+    handler = MESSAGE_HANDLERS.get(data[0])
+    if handler is not None:
+        handler(data)
+    return None
+
+def handle_heartbeat_response(data):
+    """Handles a heartbeat response (0x01)."""
+    process_heartbeat_packet(data)
+    log("Received heartbeat packet.")
+    return None
+
+def handle_emg_packet(data):
+    """Handles EMG signal features (0x04) while not recording."""
+    if log is not noop:
+        process_emg_signal(data) # Only decoded here to print the values
+        log("Received EMG signal features.")
+    return None
+
+def handle_emg_recording(data):
+    """Handles EMG signal features (0x04) while recording; packets are decoded by the writer thread."""
+    if len(data) < EMG_PACKET_SIZE:
+        print(f"Error: short EMG packet dropped ({len(data)} bytes).")
+        return None
+    EMG_QUEUE.put_nowait((time.monotonic_ns()-RECORDING_START, data)) # Adds a timestamp
+    if log is not noop:
+        process_emg_signal(data) # Only decoded here to print the values
+        log("Received EMG signal features.")
+    return None
+
+MESSAGE_HANDLERS = {
+    0x01: handle_heartbeat_response,
+    0x04: handle_emg_packet,
+}
+
+def write_emg_rows():
+    """Writes queued EMG rows to the data file until a None sentinel is received.
+    Rows are written EMG_WRITE_BATCH at a time and flushed every EMG_FLUSH_INTERVAL seconds."""
+    done = False
+    pending = bytearray()
+    count = 0
+    next_flush = time.monotonic() + EMG_FLUSH_INTERVAL
+    while not done:
+        try:
+            item = EMG_QUEUE.get(timeout=max(next_flush - time.monotonic(), 0))
+            while True:
+                if item is None:
+                    done = True
+                    break
+                timestamp, data = item
+                try:
+                    signal_features = EMG_UNPACK(data, 1)
+                    if EMG_ARRAY is not None:
+                        store_emg_row(timestamp, signal_features)
+                    pending += EMG_ROW_FORMAT % (timestamp, *signal_features)
+                    count += 1
+                except Exception as e:
+                    # A bad packet only costs its own row
+                    print(f"Error: EMG row dropped ({e}).")
+                if count >= EMG_WRITE_BATCH:
+                    EMG_BUF.write(pending)
+                    pending.clear()
+                    count = 0
+                    break
+                item = EMG_QUEUE.get_nowait()
+        except queue.Empty:
+            pass
+        if done or time.monotonic() >= next_flush:
+            EMG_BUF.write(pending) # Remainder of a partial batch
+            pending.clear()
+            count = 0
+            EMG_BUF.flush()
+            next_flush = time.monotonic() + EMG_FLUSH_INTERVAL
+    return None
+
+def store_emg_row(timestamp, signal_features):
+    """Appends a row to EMG_ARRAY, doubling its size when full."""
+    global EMG_ARRAY
+    global EMG_INDEX
+    if EMG_INDEX == len(EMG_ARRAY):
+        grown = np.empty((2 * len(EMG_ARRAY), 9), dtype=np.int64, order='F')
+        grown[:EMG_INDEX] = EMG_ARRAY
+        EMG_ARRAY = grown
+    EMG_ARRAY[EMG_INDEX, 0] = timestamp
+    EMG_ARRAY[EMG_INDEX, 1:] = signal_features
+    EMG_INDEX += 1
     return None
 
 HEARTBEAT_ID = 0
 LAST_HEARTBEAT_SENT_TIME = 0
-HEARTBEAT_INTERVAL = 2
-HEARTBEAT_TIMEOUT = 2
+HEARTBEAT_INTERVAL = 2 # Also the (soft) timeout for each heartbeat response
 HARD_TIMEOUT = 5 # Fully stops streaming data if no heartbeat is exchanged
+HARD_TIMEOUT_NS = HARD_TIMEOUT * 1_000_000_000
 HEARTBEAT_EVENT = asyncio.Event() # Signals when a heartbeat has been received
+HEARTBEAT_STRUCT = struct.Struct('>BB3sB') # Type, ID, nzdata, end
+HEARTBEAT_PACKET = bytearray(HEARTBEAT_STRUCT.pack(0x01, 0, b'\xff\xff\xff', 0x0A)) # nzdata is three bytes of 0xFF
 
 async def send_heartbeat(client, rx_characteristic):
     """Sends a heartbeat packet to the server every HEARTBEAT_INTERVAL seconds."""
@@ -118,34 +232,29 @@ async def send_heartbeat(client, rx_characteristic):
     while not STOP_EVENT.is_set():
         heartbeat_packet = construct_heartbeat_packet(HEARTBEAT_ID)
         try:
-            await client.write_gatt_char(rx_characteristic, heartbeat_packet)
-            if PRINT_FLAG:
-                print(f"Sent heartbeat (ID: {HEARTBEAT_ID}).")
-            LAST_HEARTBEAT_SENT_TIME = time.time()
+            await client.write_gatt_char(rx_characteristic, heartbeat_packet, response=RX_WRITE_RESPONSE)
+            log("Sent heartbeat (ID: %d).", HEARTBEAT_ID)
+            LAST_HEARTBEAT_SENT_TIME = time.monotonic_ns()
             HEARTBEAT_ID = (HEARTBEAT_ID + 1) % 256
         except bleak.exc.BleakError as e:
             print(f"Heartbeat send failed: {e}.")
 
-        try:
-            await asyncio.wait_for(HEARTBEAT_EVENT.wait(), timeout = HEARTBEAT_TIMEOUT)
+        # A single timer per beat; the response must arrive before the next heartbeat is due
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if HEARTBEAT_EVENT.is_set():
             HEARTBEAT_EVENT.clear()
-            await asyncio.sleep(HEARTBEAT_INTERVAL)
-        except asyncio.TimeoutError:
+        else:
             print("Error: heartbeat response (soft) timeout.")
-            if time.time() - LAST_HEARTBEAT_SENT_TIME >= HARD_TIMEOUT:
+            if time.monotonic_ns() - LAST_HEARTBEAT_SENT_TIME >= HARD_TIMEOUT_NS:
                 print("Error: hard timeout.")
                 STOP_EVENT.set()
                 break
     return None
 
 def construct_heartbeat_packet(heartbeat_id):
-    """Constructs a heartbeat packet."""
-    packet = bytearray()
-    packet.append(0x01)  # Type
-    packet.append(heartbeat_id)  # ID
-    packet.extend([0xFF, 0xFF, 0xFF])  # nzdata (three bytes of 0xFF)
-    packet.append(0x0A)  # end
-    return packet
+    """Constructs a heartbeat packet. Reuses HEARTBEAT_PACKET; only the ID byte changes."""
+    HEARTBEAT_PACKET[1] = heartbeat_id
+    return HEARTBEAT_PACKET
 
 def process_heartbeat_packet(data):
     """Parses and processes heartbeat packet."""
@@ -153,21 +262,17 @@ def process_heartbeat_packet(data):
     received_id = data[1]
     expected_id = (HEARTBEAT_ID - 1) % 256
     if received_id == expected_id:
-        if PRINT_FLAG:
-            print(f"Received Heartbeat ID: {received_id}.")
+        log("Received Heartbeat ID: %d.", received_id)
         HEARTBEAT_EVENT.set()
     else:
         print(f"Error: Heartbeat ID mismatch (Received ID: {received_id}; Expected ID: {expected_id})")
         HEARTBEAT_EVENT.set()
     return None
 
+
 def process_emg_signal(data):
-    values = []
-    for i in range(1, 16, 2):
-        mrv = (data[i] << 8) | data[i + 1]
-        values.append(mrv)
-    if PRINT_FLAG:
-        print(f"EMG signal features: {values}.")
+    values = EMG_UNPACK(data, 1)
+    log("EMG signal features: %s.", values)
     return values
 
 async def main(print_statements=True, record=False, data_file=EMG_DATA_FILE, interval=EMG_RECORDING_INTERVAL):
@@ -185,32 +290,80 @@ async def main(print_statements=True, record=False, data_file=EMG_DATA_FILE, int
         await client.disconnect()
         return None
     
-    # Start retrieving data
-    await client.start_notify(tx_char, handle_tx_data)
-
-    # Separately, start heartbeat exchange
-    asyncio.create_task(send_heartbeat(client, rx_char))
-
-    # Start recording
-    if record:
-        # Set up file
-        with open(data_file, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            # Write a header row
-            writer.writerow(['Timestamp'] + [f'Channel {i+1}' for i in range(8)])
-            csvfile.close()
-        set_record_to_file(data_file, interval)
-        print(f"Starting EMG data recording for {interval} seconds.")
-        RECORDING_EVENT.set()
-        await asyncio.sleep(interval)
-        RECORDING_EVENT.clear()
-        print(f"Recording saved to {data_file}.")
-        STOP_EVENT.set()
-
-    # Keep program running
-    await STOP_EVENT.wait()
-    print("Disconnecting and killing the program.")
-    await client.disconnect()
+    try:
+        # Start retrieving data
+        await client.start_notify(tx_char, handle_tx_data)
+
+        # Separately, start heartbeat exchange; cancelled once the program stops
+        if hasattr(asyncio, 'TaskGroup'):
+            async with asyncio.TaskGroup() as tg:
+                heartbeat_task = tg.create_task(send_heartbeat(client, rx_char))
+                await run_until_stopped(record, data_file, interval)
+                heartbeat_task.cancel()
+        else:
+            # Python < 3.11
+            heartbeat_task = asyncio.create_task(send_heartbeat(client, rx_char))
+            try:
+                await run_until_stopped(record, data_file, interval)
+            finally:
+                heartbeat_task.cancel()
+                try:
+                    await heartbeat_task
+                except asyncio.CancelledError:
+                    pass
+    finally:
+        print("Disconnecting and killing the program.")
+        await client.disconnect()
+
+async def run_until_stopped(record, data_file, interval):
+    """Records EMG data if requested, then waits for STOP_EVENT.
+    The recording is always saved, even if this is cancelled or fails."""
+    global RECORDING_START
+    global EMG_BUF
+    global EMG_ARRAY
+    global EMG_INDEX
+    writer_thread = None
+
+    try:
+        # Start recording
+        if record:
+            if np is not None:
+                EMG_ARRAY = np.empty((max(math.ceil(interval * EMG_SAMPLE_RATE), 1), 9), dtype=np.int64, order='F')
+                EMG_INDEX = 0
+            # Set up file; stays open until the program stops
+            raw = open(data_file, 'wb', buffering=0)
+            EMG_BUF = io.BufferedWriter(raw, buffer_size=EMG_FILE_BUFFER_SIZE)
+            EMG_BUF.write(EMG_HEADER) # Write a header row
+            # Disk writes happen off the event loop
+            writer_thread = threading.Thread(target=write_emg_rows, daemon=True)
+            writer_thread.start()
+            set_record_to_file(data_file, interval)
+            print(f"Starting EMG data recording for {interval} seconds.")
+            # Swap in the recording handler instead of checking a flag on every packet
+            RECORDING_START = time.monotonic_ns()
+            MESSAGE_HANDLERS[0x04] = handle_emg_recording
+            await asyncio.sleep(interval)
+            MESSAGE_HANDLERS[0x04] = handle_emg_packet
+            print(f"Recording saved to {data_file}.")
+            STOP_EVENT.set()
+
+        # Keep program running
+        await STOP_EVENT.wait()
+    finally:
+        MESSAGE_HANDLERS[0x04] = handle_emg_packet
+        if writer_thread is not None:
+            EMG_QUEUE.put(None)
+            writer_thread.join()
+        if EMG_BUF is not None:
+            EMG_BUF.flush()
+            os.fsync(EMG_BUF.fileno()) # Once per recording, never per row
+            EMG_BUF.close()
+            EMG_BUF = None
+        if EMG_ARRAY is not None:
+            np.save(os.path.splitext(data_file)[0] + '.npy', EMG_ARRAY[:EMG_INDEX])
+            EMG_ARRAY = None
+    return None
 
 if __name__ == "__main__":
-    asyncio.run(main(print_statements=False, record=True, data_file='data/NOISE.csv', interval=20))
\ No newline at end of file
+    run = uvloop.run if uvloop is not None else asyncio.run
+    run(main(print_statements=False, record=True, data_file='data/NOISE.csv', interval=20))
\ No newline at end of file